@@ -3,17 +3,34 @@
 
 # peak2osm.py
 # Merges OSM, N50 and SSR peaks
-# Usage: peak2osm.py <municipality name>
+# Usage: peak2osm.py <municipality name> [-dem=<raster file>] [-snap[=<meters>]] [-cache] [-update] [-stream[=<buffer size>]]
+#        [-metrics=<port>] [-heartbeat=<json file>] [-engine=grid|reference]
+#        peak2osm.py -verify[=<clusters>]
+#        peak2osm.py -verify-update
+#        peak2osm.py -benchmark-output[=<peaks>]
 
 
 import json
 import sys
 import os
 import math
+import struct
+import mmap
+import array
+import gc
 import urllib.request
 import zipfile
-from io import BytesIO
+import tempfile
+import multiprocessing
+import time
+import threading
+import http.server
+from io import BytesIO, StringIO
+from contextlib import redirect_stdout
+import random
+import hashlib
 from xml.etree import ElementTree as ET
+from xml.sax.saxutils import quoteattr
 import utm  # In N50 repo
 
 
@@ -27,17 +44,226 @@ overpass_api = "https://overpass-api.de/api/interpreter"  # Overpass endpoint
 
 max_offset = 1000  # Max BBOX size in meters
 
+match_engine = "grid"  # Engine for finding matches: "grid" (spatial index) or "reference" (test all pairs)
+grid_size = (0.02, 0.01)  # Size of grid cells in degrees (lon, lat)
+
+dem_filename = None  # Local DTM raster for elevation check (uncompressed GeoTIFF, or ESRI .flt/.bil with .hdr)
+dem_zone = 33  # UTM zone of raw DEM rasters (GeoTIFF must contain EPSG code)
+dem_tolerance = 5  # Max elevation difference in meters against DEM before ELE_MISMATCH
+
+snap = False  # Relocate unmatched SSR peaks to nearest local maximum in DEM
+snap_radius = 100  # Search radius in meters around SSR peak
+snap_neighbourhood = 20  # Local maximum must be the highest point within this radius in meters
+snap_cells = 20  # Max number of search cells along the search radius, independent of DEM resolution
+
+cache = False  # Load sources from binary cache files if available, or else save them
+municipality_cache = "municipalities_cache.json"  # Municipality ids and names found with -cache
+update = False  # Update local OSM snapshot with changes from Overpass instead of loading all OSM data
+
+peak_file_magic = b"PEAK2OSM\x02\x00\x00\x00\x00\x00\x00\x00"  # Binary cache file format, version 2 (16 bytes to keep columns aligned)
+peak_file_columns = ["lon", "lat", "name", "attr_start", "child_start", "child_name", "child_attr_start",
+						"attr_key", "attr_value", "child_key", "child_value", "string_start"]
+
+stream = False  # Write only new and modified elements to output file while merging, for large runs
+output_buffer = 1000000  # Characters buffered before writing to output file when streaming
+id_block = 100000  # Negative ids reserved per municipality for new nodes
+
+metrics_port = None  # Port of local HTTP endpoint with metrics in Prometheus text format, if any
+heartbeat_filename = None  # JSON file with metrics which is updated periodically, if any
+heartbeat_interval = 10  # Seconds between updates of heartbeat file
+heartbeat_lock = threading.Lock()  # Heartbeat thread and main program share the temporary file
+progress_interval = 0.5  # Seconds between updates of progress bar
+
 debug = False
 
+message_line = ""  # Unfinished line of last message, for progress output
+
+metrics = {
+	'stage': "",
+	'stage_total': 0,
+	'stage_done': 0,
+	'stage_start': time.time(),
+	'stage_end': None,
+	'next_progress': 0.0,
+	'progress_length': 0,
+	'peaks_done': 0,
+	'network_bytes': 0,
+	'output_buffer': 0,
+	'start': time.time()
+}
+
 
 
 # Output message
 
 def message (output_text):
 
+	global message_line
+
 	sys.stdout.write (output_text)
 	sys.stdout.flush()
 
+	message_line = (message_line + output_text).split("\n")[-1]
+
+
+
+# Start progress for new stage with given total number of items
+
+def start_progress (stage, total):
+
+	metrics['stage'] = stage
+	metrics['stage_total'] = total
+	metrics['stage_done'] = 0
+	metrics['stage_start'] = time.time()
+	metrics['stage_end'] = None
+	metrics['next_progress'] = metrics['stage_start'] + progress_interval
+
+
+
+# Count processed items in current stage.
+# Progress bar is only output at intervals and to terminals, to keep loops fast.
+
+def update_progress (count=1):
+
+	metrics['stage_done'] += count
+	metrics['peaks_done'] += count
+
+	if time.time() >= metrics['next_progress']:
+		metrics['next_progress'] = time.time() + progress_interval
+		if sys.stdout.isatty():
+			stage = stage_metrics()
+			text = "[%-20s] %3i%%  %i/s  ETA %i:%02i" % ("#" * int(20 * stage['ratio']), 100 * stage['ratio'],
+						stage['peaks_per_second'], stage['eta_seconds'] // 60, stage['eta_seconds'] % 60)
+			sys.stdout.write ("\r" + message_line + text.ljust(metrics['progress_length']))
+			sys.stdout.flush()
+			metrics['progress_length'] = len(text)
+
+
+
+# End progress of current stage and remove progress bar
+
+def end_progress():
+
+	metrics['stage_end'] = time.time()
+
+	if metrics['progress_length']:
+		sys.stdout.write ("\r" + message_line + " " * metrics['progress_length'] + "\r" + message_line)
+		sys.stdout.flush()
+		metrics['progress_length'] = 0
+
+
+
+# Get progress ratio, throughput and ETA of current stage
+
+def stage_metrics():
+
+	elapsed = (metrics['stage_end'] or time.time()) - metrics['stage_start']
+	done = metrics['stage_done']
+	total = metrics['stage_total']
+
+	rate = done / elapsed if elapsed > 0 else 0.0
+
+	return {
+		'ratio': min(1.0, done / total) if total else 1.0,
+		'peaks_per_second': rate,
+		'eta_seconds': int((total - done) / rate) if rate > 0 and total > done else 0,
+		'queue_depth': max(0, total - done)
+	}
+
+
+
+# Get current metrics as dict, for heartbeat file and metrics endpoint
+
+def current_metrics():
+
+	stage = stage_metrics()
+
+	return {
+		'timestamp': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+		'uptime_seconds': round(time.time() - metrics['start'], 1),
+		'stage': metrics['stage'],
+		'stage_done': metrics['stage_done'],
+		'stage_total': metrics['stage_total'],
+		'stage_ratio': round(stage['ratio'], 4),
+		'peaks_per_second': round(stage['peaks_per_second'], 1),
+		'eta_seconds': stage['eta_seconds'],
+		'queue_depth': stage['queue_depth'],
+		'peaks_done': metrics['peaks_done'],
+		'network_bytes': metrics['network_bytes'],
+		'output_buffer': metrics['output_buffer']
+	}
+
+
+
+# Save metrics to heartbeat file. File is replaced in one operation so that readers never see a partial file.
+# Writers are serialised, since they use the same temporary file.
+
+def save_heartbeat():
+
+	with heartbeat_lock:
+		file = open(heartbeat_filename + ".tmp", "w")
+		json.dump(current_metrics(), file, indent=2, ensure_ascii=False)
+		file.close()
+		os.replace(heartbeat_filename + ".tmp", heartbeat_filename)
+
+
+
+# Start local HTTP endpoint with metrics in Prometheus text format, and periodic heartbeat file.
+# Both run in background threads.
+
+def start_metrics():
+
+	class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+		def do_GET(self):
+
+			current = current_metrics()
+			lines = []
+			for key, metric_type, help_text in [
+					('stage_done', "gauge", "Items processed in current stage"),
+					('stage_total', "gauge", "Total items in current stage"),
+					('stage_ratio', "gauge", "Progress of current stage"),
+					('peaks_per_second', "gauge", "Throughput of current stage"),
+					('eta_seconds', "gauge", "Estimated seconds left of current stage"),
+					('queue_depth', "gauge", "Items waiting in current stage"),
+					('peaks_done', "counter", "Items processed in all stages"),
+					('network_bytes', "counter", "Bytes loaded from network"),
+					('output_buffer', "gauge", "Characters waiting in output buffer"),
+					('uptime_seconds', "gauge", "Seconds since start")]:
+				name = "peak2osm_" + key
+				lines.append("# HELP %s %s" % (name, help_text))
+				lines.append("# TYPE %s %s" % (name, metric_type))
+				if key.startswith("stage") or key in ['peaks_per_second', 'eta_seconds', 'queue_depth']:
+					lines.append('%s{stage="%s"} %s' % (name, current['stage'].replace('"', '\\"'), current[ key ]))
+				else:
+					lines.append("%s %s" % (name, current[ key ]))
+
+			body = ("\n".join(lines) + "\n").encode("utf-8")
+			self.send_response(200)
+			self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+			self.send_header("Content-Length", str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def log_message(self, format, *args):
+			pass  # Keep requests out of stdout
+
+
+	def heartbeat():
+
+		while True:
+			save_heartbeat()
+			time.sleep(heartbeat_interval)
+
+
+	if metrics_port:
+		server = http.server.ThreadingHTTPServer(("127.0.0.1", metrics_port), MetricsHandler)
+		threading.Thread(target=server.serve_forever, daemon=True).start()
+		message ("Metrics at http://localhost:%i/metrics\n" % metrics_port)
+
+	if heartbeat_filename:
+		threading.Thread(target=heartbeat, daemon=True).start()
+
 
 
 # Compute approximation of distance between two coordinates, (lon,lat), in meters
@@ -75,6 +301,37 @@ def create_bbox (node, offset):
 	return bbox
 
 
+
+# Convert (lon, lat) to UTM (x, y) in given zone, using Krüger series
+# Accurate to millimeters also outside of zone, which is needed for Norway in zone 33
+
+def utm_coordinates (point, zone):
+
+	a = 6378137.0
+	f = 1 / 298.257223563
+	k0 = 0.9996
+
+	n = f / (2 - f)
+	A = a / (1 + n) * (1 + n**2 / 4 + n**4 / 64)
+	alpha = [ n / 2 - 2 * n**2 / 3 + 5 * n**3 / 16, 13 * n**2 / 48 - 3 * n**3 / 5, 61 * n**3 / 240 ]
+	e = 2 * math.sqrt(n) / (1 + n)
+
+	lat = math.radians(point[1])
+	lon = math.radians(point[0] - (zone * 6 - 183))
+
+	t = math.sinh(math.atanh(math.sin(lat)) - e * math.atanh(e * math.sin(lat)))
+	xi = math.atan2(t, math.cos(lon))
+	eta = math.atanh(math.sin(lon) / math.sqrt(1 + t*t))
+
+	x = eta
+	y = xi
+	for j in range(1, 4):
+		x += alpha[ j - 1 ] * math.cos(2 * j * xi) * math.sinh(2 * j * eta)
+		y += alpha[ j - 1 ] * math.sin(2 * j * xi) * math.cosh(2 * j * eta)
+
+	return (500000.0 + k0 * A * x, k0 * A * y)
+
+
  
 # Calculate Jaro Similarity of two strings
 # Source: https://www.geeksforgeeks.org/jaro-and-jaro-winkler-similarity/
@@ -216,10 +473,20 @@ def compare_names(tags1, tags2):
 
 
 
-# Get name or id of municipality from GeoNorge api
+# Get name or id of municipality from GeoNorge api.
+# With -cache, municipalities already found are kept in a small JSON file, so that fully cached runs need no network.
 
 def get_municipality (query):
 
+	key = query.lower()
+	known = {}
+	if cache and os.path.isfile(municipality_cache):
+		file = open(municipality_cache)
+		known = json.load(file)
+		file.close()
+		if key in known:
+			return tuple(known[ key ])
+
 	if query.isdigit():
 		url = "https://ws.geonorge.no/kommuneinfo/v1/kommuner/" + query
 	else:
@@ -235,25 +502,36 @@ def get_municipality (query):
 		else:
 			raise
 
+	data = file.read()
+	file.close()
+	metrics['network_bytes'] += len(data)
+
 	if query.isdigit():
-		result = json.load(file)
-		file.close()
+		result = json.loads(data)
 		municipality_name = result['kommunenavnNorsk']
-		return (query, municipality_name)
+		municipality = (query, municipality_name)
 
 	else:
-		result = json.load(file)
-		file.close()
+		result = json.loads(data)
 		if result['antallTreff'] == 1:
 			municipality_id = result['kommuner'][0]['kommunenummer']
 			municipality_name = result['kommuner'][0]['kommunenavnNorsk']
-			return (municipality_id, municipality_name)
+			municipality = (municipality_id, municipality_name)
 		else:
 			municipalities = []
 			for municipality in result['kommuner']:
 				municipalities.append(municipality['kommunenummer'] + " " + municipalities['kommunenavnNorsk'])
 			sys.exit("\tMore than one municipality found: %s\n\n" % ", ".join(municipalities))
 
+	if cache:
+		known[ key ] = municipality
+		known[ municipality[0] ] = municipality
+		file = open(municipality_cache, "w")
+		json.dump(known, file, indent=2, ensure_ascii=False)
+		file.close()
+
+	return municipality
+
 
 
 # Get tags of OSM or N50 element (XML data structure)
@@ -276,10 +554,269 @@ def get_tags(xml_element):
 
 
 
+# Get filename of binary cache file for given source ("ssr", "n50" or "osm")
+
+def cache_filename (source):
+
+	return "%s_%s_%s_peaks.bin" % (source, municipality_id, municipality_name.replace(" ", "_"))
+
+
+
+# Save records to compact binary file.
+# Each record is a tuple (name, point, attributes, children), where point is (lon, lat) or None,
+# attributes is a dict of strings and children is a list of (name, attributes) tuples.
+# Coordinates and indexes are stored as columns in native byte order, and all strings once in a shared string table.
+
+def save_peak_file (filename, records):
+
+	strings = {}
+
+	def string_id(text):
+		if text not in strings:
+			strings[ text ] = len(strings)
+		return strings[ text ]
+
+	columns = {
+		'lon': array.array("d"),
+		'lat': array.array("d"),
+		'name': array.array("I"),
+		'attr_start': array.array("I", [0]),
+		'child_start': array.array("I", [0]),
+		'child_name': array.array("I"),
+		'child_attr_start': array.array("I", [0]),
+		'attr_key': array.array("I"),
+		'attr_value': array.array("I"),
+		'child_key': array.array("I"),
+		'child_value': array.array("I"),
+		'string_start': array.array("I", [0])
+	}
+
+	for name, point, attributes, children in records:
+		columns['name'].append(string_id(name))
+		columns['lon'].append(point[0] if point else math.nan)
+		columns['lat'].append(point[1] if point else math.nan)
+		for key, value in attributes.items():
+			columns['attr_key'].append(string_id(key))
+			columns['attr_value'].append(string_id(str(value)))
+		columns['attr_start'].append(len(columns['attr_key']))
+
+		for child_name, child_attributes in children:
+			columns['child_name'].append(string_id(child_name))
+			for key, value in child_attributes.items():
+				columns['child_key'].append(string_id(key))
+				columns['child_value'].append(string_id(str(value)))
+			columns['child_attr_start'].append(len(columns['child_key']))
+		columns['child_start'].append(len(columns['child_name']))
+
+	blob = bytearray()
+	for text in strings:  # Insertion order is id order
+		blob.extend(text.encode("utf-8"))
+		columns['string_start'].append(len(blob))
+
+	# Written to temporary file which then replaces the old file, so that an interrupted run never leaves a partial file.
+	# Magic and header are multiples of 8 bytes, and each column is padded, so all columns start 8 byte aligned.
+
+	file = open(filename + ".tmp", "wb")
+	file.write(peak_file_magic)
+	file.write(struct.pack("<" + "Q" * (len(peak_file_columns) + 1), *([ len(columns[ key ]) for key in peak_file_columns ] + [ len(blob) ])))
+	for key in peak_file_columns:
+		file.write(columns[ key ])
+		file.write(bytes(-len(columns[ key ]) * columns[ key ].itemsize % 8))  # Align to 8 bytes
+	file.write(blob)
+	file.close()
+	os.replace(filename + ".tmp", filename)
+
+
+
+# Check magic and size of binary file against the column lengths in its header.
+# Returns the column lengths (plus length of string table), or None if not a complete file of the current format.
+
+def peak_file_lengths (data):
+
+	header_size = len(peak_file_magic) + 8 * (len(peak_file_columns) + 1)
+	if len(data) < header_size or data[ : len(peak_file_magic) ] != peak_file_magic:
+		return None
+
+	lengths = struct.unpack_from("<" + "Q" * (len(peak_file_columns) + 1), data, len(peak_file_magic))
+
+	size = header_size
+	for key, length in zip(peak_file_columns, lengths):
+		column_size = length * struct.calcsize("d" if key in ["lon", "lat"] else "I")
+		size += column_size + (-column_size % 8)
+	size += lengths[-1]
+
+	if size != len(data):
+		return None
+
+	return lengths
+
+
+
+# Check if file is a complete binary file of the current format, without loading it
+
+def valid_peak_file (filename):
+
+	if not os.path.isfile(filename) or os.path.getsize(filename) == 0:  # Empty file cannot be memory mapped
+		return False
+
+	file = open(filename, "rb")
+	data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+	file.close()
+	valid = peak_file_lengths(data) is not None
+	data.close()
+
+	return valid
+
+
+
+# Load records from compact binary file, as saved by save_peak_file().
+# Columns are cast directly from the memory map without parsing.
+
+def load_peak_file (filename):
+
+	if os.path.getsize(filename) == 0:  # Empty file cannot be memory mapped
+		sys.exit("\n\n\t*** Unknown format of file '%s'\n\n" % filename)
+
+	file = open(filename, "rb")
+	data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+	file.close()
+
+	lengths = peak_file_lengths(data)
+	if lengths is None:
+		data.close()
+		sys.exit("\n\n\t*** Unknown format of file '%s'\n\n" % filename)
+
+	offset = len(peak_file_magic) + 8 * len(lengths)
+
+	view = memoryview(data)
+	columns = {}
+	for key, length in zip(peak_file_columns, lengths):
+		item = "d" if key in ["lon", "lat"] else "I"
+		size = length * struct.calcsize(item)
+		columns[ key ] = view[ offset : offset + size ].cast(item)
+		offset += size + (-size % 8)
+
+	blob = view[ offset : offset + lengths[-1] ]
+	string_start = columns['string_start']
+	strings = [ str(blob[ string_start[ i ] : string_start[ i + 1 ] ], "utf-8") for i in range(len(string_start) - 1) ]
+
+	# Resolve string ids column by column before building records
+
+	lon = columns['lon'].tolist()
+	lat = columns['lat'].tolist()
+	name = [ strings[ i ] for i in columns['name'].tolist() ]
+	attr_start = columns['attr_start'].tolist()
+	attr_key = [ strings[ i ] for i in columns['attr_key'].tolist() ]
+	attr_value = [ strings[ i ] for i in columns['attr_value'].tolist() ]
+	child_start = columns['child_start'].tolist()
+	child_name = [ strings[ i ] for i in columns['child_name'].tolist() ]
+	child_attr_start = columns['child_attr_start'].tolist()
+	child_key = [ strings[ i ] for i in columns['child_key'].tolist() ]
+	child_value = [ strings[ i ] for i in columns['child_value'].tolist() ]
+
+	# Records have no reference cycles, so avoid repeated garbage collections while building them
+
+	gc_enabled = gc.isenabled()
+	gc.disable()
+	try:
+		records = []
+		for i in range(len(name)):
+			attributes = dict(zip(attr_key[ attr_start[ i ] : attr_start[ i + 1 ] ], attr_value[ attr_start[ i ] : attr_start[ i + 1 ] ]))
+			children = []
+			for j in range(child_start[ i ], child_start[ i + 1 ]):
+				start, end = child_attr_start[ j ], child_attr_start[ j + 1 ]
+				children.append((child_name[ j ], dict(zip(child_key[ start : end ], child_value[ start : end ]))))
+			point = (lon[ i ], lat[ i ]) if lon[ i ] == lon[ i ] else None  # NaN if no point
+			records.append((name[ i ], point, attributes, children))
+	finally:
+		if gc_enabled:
+			gc.enable()
+
+	for column in list(columns.values()) + [ blob, view ]:
+		column.release()
+	data.close()
+
+	return records
+
+
+
+# Save peaks to binary cache file for given source
+
+def save_cached_peaks (source, peaks):
+
+	save_peak_file(cache_filename(source), [ ("peak", peak['point'], peak['tags'], []) for peak in peaks ])
+
+
+
+# Load peaks from binary cache file for given source into given list of peaks
+
+def load_cached_peaks (source, peaks):
+
+	records = load_peak_file(cache_filename(source))
+
+	gc_enabled = gc.isenabled()
+	gc.disable()
+	try:
+		for name, point, tags, children in records:
+			element = {
+				'point': point,
+				'tags': tags,
+				'bbox': create_bbox(point, max_offset)
+			}
+			peaks.append(element)
+	finally:
+		if gc_enabled:
+			gc.enable()
+
+
+
+# Convert OSM XML tree to records for binary file. Coordinates of nodes are stored as points.
+
+def osm_records (root):
+
+	records = [ (root.tag, None, root.attrib, []) ]
+
+	for element in root:
+		if element.tag != "note":
+			attributes = { key: value for key, value in element.attrib.items() if key not in ["lat", "lon"] }
+			if "lat" in element.attrib:
+				point = ( float(element.attrib['lon']), float(element.attrib['lat']) )
+			else:
+				point = None
+			records.append((element.tag, point, attributes, [ (child.tag, child.attrib) for child in element ]))
+
+	return records
+
+
+
+# Convert records from binary file back to OSM XML tree
+
+def osm_xml (records):
+
+	root = ET.Element(records[0][0], records[0][2])
+
+	for name, point, attributes, children in records[1:]:
+		element = ET.SubElement(root, name, attributes)
+		if point:
+			element.set("lat", str(point[1]))
+			element.set("lon", str(point[0]))
+		for child_name, child_attributes in children:
+			ET.SubElement(element, child_name, child_attributes)
+
+	return root
+
+
+
 # Load peak names from SSR
 
 def load_ssr_peak_names():
 
+	if cache and os.path.isfile(cache_filename("ssr")):
+		message ("\tLoad SSR peak names from cache ... ")
+		load_cached_peaks("ssr", ssr_peaks)
+		message ("%i peak names loaded\n" % len(ssr_peaks))
+		return
+
 	message ("\tLoad SSR peak names ... ")
 
 	filename = "stedsnavn_%s_%s.geojson" % (municipality_id, municipality_name.replace(" ", "_"))
@@ -287,7 +824,10 @@ def load_ssr_peak_names():
 	ssr_data = json.load(file)
 	file.close()
 
+	start_progress("Load SSR", len(ssr_data['features']))
+
 	for feature in ssr_data['features'][:]:
+		update_progress()
 		if "GRUPPE" in feature['properties'] and feature['properties']['GRUPPE'] == "høyder":
 			tags = {}
 			for key, value in iter(feature['properties'].items()):
@@ -307,8 +847,12 @@ def load_ssr_peak_names():
 		if feature['properties']['GRUPPE'] != "høyder":  # For source output
 			ssr_data['features'].remove(feature)
 
+	end_progress()
 	message ("%i peak names loaded\n" % len(ssr_peaks))
 
+	if cache:
+		save_cached_peaks("ssr", ssr_peaks)
+
 	# Save SSR file for debugging
 
 	if debug:
@@ -377,6 +921,12 @@ def load_n50_peaks():
 						.replace("æ","e").replace("ø","o").replace("å","a").replace(" ", "_")
 
 
+	if cache and os.path.isfile(cache_filename("n50")):
+		message ("\tLoad N50 peaks from cache ... ")
+		load_cached_peaks("n50", n50_peaks)
+		message ("%i peaks loaded\n" % len(n50_peaks))
+		return
+
 	message ("\tLoad N50 peaks from Kartverket ... ")
 
 	# Load latest N50 file for municipality from Kartverket
@@ -389,7 +939,9 @@ def load_n50_peaks():
 
 	request = urllib.request.Request(url, headers=header)
 	file_in = urllib.request.urlopen(request)
-	zip_file = zipfile.ZipFile(BytesIO(file_in.read()))
+	data = file_in.read()
+	metrics['network_bytes'] += len(data)
+	zip_file = zipfile.ZipFile(BytesIO(data))
 
 	filename2 = filename1.replace("Kartdata", "Hoyde")
 	file = zip_file.open(filename2 + ".gml")
@@ -432,6 +984,9 @@ def load_n50_peaks():
 
 	message ("%i peaks loaded\n" % count)
 
+	if cache:
+		save_cached_peaks("n50", n50_peaks)
+
 	# Save to file for debugging
 
 	if debug:
@@ -459,38 +1014,120 @@ def load_n50_peaks():
 
 
 
-# Load existing peaks in OSM
+# Load existing peaks in OSM.
+# With update option, a local snapshot is patched with elements changed since the snapshot was made.
 
 def load_osm_peaks():
 
 	global osm_root, osm_tree
 
-	message ("\tLoad existing OSM peaks from Overpass ...")
+	# Get data from Overpass for given query
+
+	def overpass_query(query):
+
+		request = urllib.request.Request(overpass_api + "?data=" + urllib.parse.quote('[timeout:200];' + query), headers=header)
+		try:
+			file = urllib.request.urlopen(request)
+		except urllib.error.HTTPError as err:
+			sys.exit("\n\n\t*** %s\n\n" % err)
+		data = file.read()
+		file.close()
+		metrics['network_bytes'] += len(data)
+
+		return data
+
+
+	# Patch snapshot records with elements which are new, changed or deleted since the snapshot.
+	# Ids of all current elements are loaded for the deletion check, but full data only for changed elements.
+
+	def update_snapshot(snapshot):
+
+		osm_base = [ record[2]['osm_base'] for record in snapshot if record[0] == "meta" ][0]
+
+		data = overpass_query(peak_query +
+								'(._;>;<;)->.b;'
+								'.b out ids;'
+								'(node.b(newer:"%s");way.b(newer:"%s");relation.b(newer:"%s"););'
+								'out meta;' % (osm_base, osm_base, osm_base))
+		size = len(data)
+
+		element_types = ["node", "way", "relation"]
+
+		response = osm_records(ET.fromstring(data))
+		current = set((record[0], record[2]['id']) for record in response if record[0] in element_types)
+		changed = [ record for record in response if record[0] in element_types and "version" in record[2] ]
+
+		elements = {}
+		for record in snapshot:
+			if record[0] in element_types and (record[0], record[2]['id']) in current:
+				elements[ (record[0], record[2]['id']) ] = record
+		deleted = len([ record for record in snapshot if record[0] in element_types ]) - len(elements)
+
+		for record in changed:
+			elements[ (record[0], record[2]['id']) ] = record
+
+		# Load elements which have entered the data set without being changed, e.g. nodes of changed ways
+
+		missing = current - set(elements)
+		if missing:
+			query = "("
+			for element_type in element_types:
+				ids = [ element_id for missing_type, element_id in missing if missing_type == element_type ]
+				if ids:
+					query += "%s(id:%s);" % (element_type, ",".join(ids))
+			data = overpass_query(query + ");out meta;")
+			size += len(data)
+			for record in osm_records(ET.fromstring(data)):
+				if record[0] in element_types:
+					elements[ (record[0], record[2]['id']) ] = record
+
+		records = [ response[0] ] + [ record for record in response if record[0] == "meta" ]
+		records.extend(sorted(elements.values(), key=lambda record: (element_types.index(record[0]), int(record[2]['id']))))
+
+		message ("%i changed, %i deleted, %i kB ... " % (len(changed) + len(missing), deleted, size // 1000))
+
+		return records
+
 
 	area_query = '[ref=%s][admin_level=7][place=municipality]' % municipality_id
 
-	query = ('[timeout:200];'
-				'(area%s;)->.a;'
-				'('
-					'nwr["natural"="peak"](area.a);'
-					'nwr["natural"="hill"](area.a);'
-					'nwr["natural"="cliff"](area.a);'
-					'nwr["natural"="mountain_range"](area.a);'
-					'nwr["natural"="ridge"](area.a);'
-					'nwr["tourism"="viewpoint"](area.a);'
-				');'
-				'(._;>;<;);'
-				'out meta;' % area_query)
-
-	request = urllib.request.Request(overpass_api + "?data=" + urllib.parse.quote(query), headers=header)
-	try:
-		file = urllib.request.urlopen(request)
-	except urllib.error.HTTPError as err:
-		sys.exit("\n\n\t*** %s\n\n" % err)
-	data = file.read()
-	file.close()
+	peak_query = ('(area%s;)->.a;'
+					'('
+						'nwr["natural"="peak"](area.a);'
+						'nwr["natural"="hill"](area.a);'
+						'nwr["natural"="cliff"](area.a);'
+						'nwr["natural"="mountain_range"](area.a);'
+						'nwr["natural"="ridge"](area.a);'
+						'nwr["tourism"="viewpoint"](area.a);'
+					');' % area_query)
+
+	# An incomplete snapshot, e.g. from an interrupted run, is replaced by a full load from Overpass
+
+	snapshot = update and valid_peak_file(cache_filename("osm"))
+	if update and os.path.isfile(cache_filename("osm")) and not snapshot:
+		message ("\tIgnore incomplete OSM snapshot '%s'\n" % cache_filename("osm"))
+
+	if snapshot:
+		message ("\tUpdate existing OSM peaks from Overpass ... ")
+		records = update_snapshot(load_peak_file(cache_filename("osm")))
+		save_peak_file(cache_filename("osm"), records)
+		osm_root = osm_xml(records)
+
+	elif cache and not update and os.path.isfile(cache_filename("osm")):
+		message ("\tLoad existing OSM peaks from cache ... ")
+		osm_root = osm_xml(load_peak_file(cache_filename("osm")))
+
+	else:
+		message ("\tLoad existing OSM peaks from Overpass ...")
+
+		data = overpass_query(peak_query +
+								'(._;>;<;);'
+								'out meta;')
+		osm_root = ET.fromstring(data)
+
+		if cache or update:
+			save_peak_file(cache_filename("osm"), osm_records(osm_root))
 
-	osm_root = ET.fromstring(data)
 	osm_tree = ET.ElementTree(osm_root)
 
 	for node in osm_root.iter("node"):
@@ -514,19 +1151,434 @@ def load_osm_peaks():
 
 
 
+# Load local DEM raster as memory map.
+# Supports uncompressed GeoTIFF/BigTIFF (striped or tiled) and raw ESRI .flt/.bil rasters with .hdr file.
+# Only the block layout is parsed; pixels are read on demand from the memory map.
+
+def load_dem (filename):
+
+	# Parse TIFF header and first IFD into dict of tag values
+
+	def parse_geotiff(data):
+
+		endian = "<" if data[:2] == b"II" else ">"
+
+		if struct.unpack_from(endian + "H", data, 2)[0] == 43:  # BigTIFF
+			ifd = struct.unpack_from(endian + "Q", data, 8)[0]
+			entry_count = struct.unpack_from(endian + "Q", data, ifd)[0]
+			entry_format, entry_size, value_format = endian + "HHQ", 20, endian + "Q"
+			ifd += 8
+		else:
+			ifd = struct.unpack_from(endian + "I", data, 4)[0]
+			entry_count = struct.unpack_from(endian + "H", data, ifd)[0]
+			entry_format, entry_size, value_format = endian + "HHI", 12, endian + "I"
+			ifd += 2
+
+		tiff_types = {1: "B", 2: "s", 3: "H", 4: "I", 6: "b", 7: "B", 8: "h", 9: "i", 11: "f", 12: "d", 16: "Q", 17: "q", 18: "Q"}
+
+		fields = {}
+		for i in range(entry_count):
+			entry = ifd + i * entry_size
+			tag, field_type, count = struct.unpack_from(entry_format, data, entry)
+			if field_type not in tiff_types:
+				continue
+			offset = entry + struct.calcsize(entry_format)
+			if struct.calcsize(tiff_types[ field_type ]) * count > struct.calcsize(value_format):
+				offset = struct.unpack_from(value_format, data, offset)[0]
+			if field_type == 2:
+				fields[ tag ] = data[ offset : offset + count ].rstrip(b"\x00").decode("ascii")
+			else:
+				fields[ tag ] = struct.unpack_from("%s%i%s" % (endian, count, tiff_types[ field_type ]), data, offset)
+
+		if fields.get(259, (1,))[0] != 1 or fields.get(277, (1,))[0] != 1:
+			sys.exit("\n\n\t*** DEM must be an uncompressed single band raster, "
+						"for example: gdal_translate -co COMPRESS=NONE -co TILED=YES -co BIGTIFF=IF_SAFER\n\n")
+
+		sample_types = {(1, 8): "B", (1, 16): "H", (1, 32): "I", (2, 16): "h", (2, 32): "i", (3, 32): "f", (3, 64): "d"}
+		sample_type = (fields.get(339, (1,))[0], fields[258][0])
+		if sample_type not in sample_types:
+			sys.exit("\n\n\t*** Unsupported DEM sample format %s\n\n" % str(sample_type))
+
+		dem = {
+			'endian': endian,
+			'item': sample_types[ sample_type ],
+			'width': fields[256][0],
+			'height': fields[257][0]
+		}
+
+		if 322 in fields:  # Tiled
+			dem['block_width'] = fields[322][0]
+			dem['block_height'] = fields[323][0]
+			dem['offsets'] = fields[324]
+		else:  # Striped
+			dem['block_width'] = dem['width']
+			dem['block_height'] = fields.get(278, (dem['height'],))[0]
+			dem['offsets'] = fields[273]
+
+		# Georeference from tie point, pixel scale and EPSG code (UTM zones only)
+
+		if 33550 not in fields or 33922 not in fields:
+			sys.exit("\n\n\t*** DEM must be georeferenced with tie point and pixel scale, not with a transformation matrix\n\n")
+
+		scale = fields[33550]
+		tiepoint = fields[33922]
+		dem['dx'] = scale[0]
+		dem['dy'] = scale[1]
+		dem['x0'] = tiepoint[3] - tiepoint[0] * scale[0]
+		dem['y0'] = tiepoint[4] + tiepoint[1] * scale[1]
+		dem['zone'] = None
+
+		geokeys = fields.get(34735, (1, 1, 0, 0))
+		for i in range(4, 4 + 4 * geokeys[3], 4):
+			key, location, count, value = geokeys[ i : i + 4 ]
+			if key == 3072:  # ProjectedCSTypeGeoKey
+				if location == 0 and (25801 <= value <= 25860 or 32601 <= value <= 32660):  # ETRS89 or WGS84 UTM
+					dem['zone'] = value % 100
+				else:
+					sys.exit("\n\n\t*** DEM must be in a UTM projection (EPSG:258xx or EPSG:326xx), not EPSG:%i\n\n" % value)
+			elif key == 1025 and value == 2:  # PixelIsPoint
+				dem['x0'] -= 0.5 * dem['dx']
+				dem['y0'] += 0.5 * dem['dy']
+
+		if dem['zone'] is None:
+			sys.exit("\n\n\t*** DEM has no projected EPSG code; it must be in a UTM projection (EPSG:258xx or EPSG:326xx)\n\n")
+
+		if 42113 in fields and fields[42113]:
+			dem['nodata'] = float(fields[42113])
+		else:
+			dem['nodata'] = None
+
+		return dem
+
+
+	# Parse ESRI .hdr file of raw raster (.flt float grid or .bil)
+
+	def parse_raw_raster(filename):
+
+		hdr = {}
+		file = open(os.path.splitext(filename)[0] + ".hdr")
+		for line in file:
+			if line.strip():
+				key, value = line.split(None, 1)
+				hdr[ key.lower() ] = value.strip().lower()
+		file.close()
+
+		if int(hdr.get("nbands", "1")) != 1:
+			sys.exit("\n\n\t*** DEM must be a single band raster\n\n")
+
+		bits = int(hdr.get("nbits", "32"))
+		if filename.lower().endswith(".flt") or hdr.get("pixeltype", "") == "float":
+			item = {32: "f", 64: "d"}[ bits ]
+		elif hdr.get("pixeltype", "") == "signedint":
+			item = {8: "b", 16: "h", 32: "i"}[ bits ]
+		else:
+			item = {8: "B", 16: "H", 32: "I"}[ bits ]
+
+		dem = {
+			'endian': ">" if hdr.get("byteorder", "i") in ["m", "msbfirst"] else "<",
+			'item': item,
+			'width': int(hdr['ncols']),
+			'height': int(hdr['nrows']),
+			'zone': dem_zone
+		}
+
+		dem['block_width'] = dem['width']
+		dem['block_height'] = dem['height']
+		dem['offsets'] = (int(hdr.get("skipbytes", "0")),)
+
+		if "cellsize" in hdr:
+			dem['dx'] = dem['dy'] = float(hdr['cellsize'])
+		else:
+			dem['dx'] = float(hdr['xdim'])
+			dem['dy'] = float(hdr['ydim'])
+
+		if "ulxmap" in hdr:  # BIL: Center of upper left pixel
+			dem['x0'] = float(hdr['ulxmap']) - 0.5 * dem['dx']
+			dem['y0'] = float(hdr['ulymap']) + 0.5 * dem['dy']
+		else:  # ESRI: Lower left corner or center
+			dem['x0'] = float(hdr.get("xllcorner", hdr.get("xllcenter")))
+			dem['y0'] = float(hdr.get("yllcorner", hdr.get("yllcenter"))) + dem['height'] * dem['dy']
+			if "xllcenter" in hdr:
+				dem['x0'] -= 0.5 * dem['dx']
+				dem['y0'] -= 0.5 * dem['dy']
+
+		nodata = hdr.get("nodata_value", hdr.get("nodata", None))
+		dem['nodata'] = float(nodata) if nodata is not None else None
+
+		return dem
+
+
+	message ("\tLoad DEM raster ... ")
+
+	filename = os.path.expanduser(filename)
+	file = open(filename, "rb")
+	data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+	file.close()
+
+	if data[:2] in [b"II", b"MM"]:
+		dem = parse_geotiff(data)
+	else:
+		dem = parse_raw_raster(filename)
+
+	dem['data'] = data
+	dem['item_size'] = struct.calcsize(dem['item'])
+	dem['blocks_across'] = (dem['width'] + dem['block_width'] - 1) // dem['block_width']
+
+	message ("%i x %i pixels, %.1f m resolution, UTM zone %i\n" % (dem['width'], dem['height'], dem['dx'], dem['zone']))
+
+	return dem
+
+
+
+# Get file offset of given DEM pixel, or None if outside of raster
+
+def dem_offset (dem, col, row):
+
+	if not (0 <= col < dem['width'] and 0 <= row < dem['height']):
+		return None
+
+	block = (row // dem['block_height']) * dem['blocks_across'] + col // dem['block_width']
+	pixel = (row % dem['block_height']) * dem['block_width'] + col % dem['block_width']
+
+	return dem['offsets'][ block ] + pixel * dem['item_size']
+
+
+
+# Get DEM elevations for list of (lon, lat) points.
+# Pixels are read in file order so that the memory map is paged sequentially through large rasters.
+# Returns list of elevations, with None for points outside of raster or with no data.
+
+def sample_dem (dem, points):
+
+	start_progress("Sample DEM", len(points))
+
+	pixels = []
+	for i, point in enumerate(points):
+		update_progress()
+		x, y = utm_coordinates(point, dem['zone'])
+		col = math.floor((x - dem['x0']) / dem['dx'])
+		row = math.floor((dem['y0'] - y) / dem['dy'])
+		offset = dem_offset(dem, col, row)
+		if offset is not None:
+			pixels.append((offset, i))
+
+	pixels.sort()
+
+	unpack = struct.Struct(dem['endian'] + dem['item']).unpack_from
+	data = dem['data']
+	nodata = dem['nodata']
+
+	elevations = [ None ] * len(points)
+	for offset, i in pixels:
+		value = unpack(data, offset)[0]
+		if value != nodata and not math.isnan(value):
+			elevations[ i ] = value
+
+	end_progress()
+
+	return elevations
+
+
+
+# Read rectangular window of DEM pixels as list of row arrays.
+# Each row is copied with one slice per raster block. Pixels outside of raster get lowest possible value.
+
+def read_dem_window (dem, col0, row0, cols, rows):
+
+	data = dem['data']
+	item = dem['item']
+	item_size = dem['item_size']
+	block_width = dem['block_width']
+	swap = (dem['endian'] == "<") != (sys.byteorder == "little")
+
+	window = []
+	for row in range(row0, row0 + rows):
+		line = array.array(item)
+		if not 0 <= row < dem['height']:
+			line.extend([ dem_padding(dem) ] * cols)
+			window.append(line)
+			continue
+
+		col = col0
+		while col < col0 + cols:
+			if not 0 <= col < dem['width']:
+				line.append(dem_padding(dem))
+				col += 1
+			else:
+				count = min(col0 + cols, dem['width'], (col // block_width + 1) * block_width) - col
+				offset = dem_offset(dem, col, row)
+				segment = array.array(item, data[ offset : offset + count * item_size ])
+				if swap:
+					segment.byteswap()
+				line.extend(segment)
+				col += count
+
+		window.append(line)
+
+	return window
+
+
+
+# Get value used for pixels outside of DEM raster
+
+def dem_padding (dem):
+
+	if dem['item'] in ["f", "d"]:
+		return -math.inf
+	elif dem['item'].islower():  # Signed
+		return -2 ** (8 * dem['item_size'] - 1)
+	else:
+		return 0
+
+
+
+# Find nearest local maximum in DEM within given radius for list of (lon, lat) points.
+# The search is done in a grid of at most snap_cells cells along the radius, each holding the highest pixel
+# of its block of DEM pixels. Only reading and pooling of pixels, which is done inside builtins, depends on DEM resolution.
+# A local maximum is a cell which is the highest within snap_neighbourhood (square) and strictly higher
+# than its 8 neighbours. Equal neighbours are accepted only for a small plateau where no cell has anything
+# higher within its neighbourhood, so that flat areas such as lakes are never chosen.
+# The peak is then moved to the highest pixel within the cell. Windows are read in file order.
+# Returns list of new points, with None if no local maximum was found or if already at the maximum.
+
+def snap_dem (dem, points, radius):
+
+	s = max(1, int(math.ceil(radius / (dem['dx'] * snap_cells))))  # Pixels per cell side
+	r = max(1, int(math.ceil(radius / (dem['dx'] * s))))  # Search radius in cells
+	k = max(1, int(round(snap_neighbourhood / (dem['dx'] * s))))  # Neighbourhood radius in cells
+	cells = 2 * (r + k) + 1  # Window size in cells
+	size = cells * s  # Window size in pixels
+	center = r + k
+
+	# Cell offsets within search radius, sorted by distance from center
+
+	search = sorted((dc*dc + dr*dr, dr, dc) for dr in range(-r, r + 1) for dc in range(-r, r + 1) if dc*dc + dr*dr <= r*r)
+	neighbours = [ (dr, dc) for dr in [-1, 0, 1] for dc in [-1, 0, 1] if dr or dc ]
+	max_plateau = (2 * k + 1) ** 2  # Max number of cells in flat summit
+	padding = dem_padding(dem)
+	nodata = dem['nodata']
+
+	windows = []
+	for i, point in enumerate(points):
+		x, y = utm_coordinates(point, dem['zone'])
+		col = math.floor((x - dem['x0']) / dem['dx'])
+		row = math.floor((dem['y0'] - y) / dem['dy'])
+		if dem_offset(dem, col, row) is not None:
+			windows.append((dem_offset(dem, col, row), col, row, i))
+
+	windows.sort()
+
+	start_progress("Snap to DEM", len(windows))
+
+	new_points = [ None ] * len(points)
+	for offset, col, row, i in windows:
+		update_progress()
+		col0 = col - center * s - s // 2
+		row0 = row - center * s - s // 2
+		window = read_dem_window(dem, col0, row0, size, size)
+
+		# Highest pixel of each cell, then highest cell within neighbourhood (separable running max).
+		# The map(max, ...) calls keep the per pixel work inside builtins.
+
+		if s > 1:
+			pooled = [ list(map(max, *window[ j : j + s ])) for j in range(0, size, s) ]
+			grid = [ list(map(max, *[ line[ j :: s ] for j in range(s) ])) for line in pooled ]
+		else:
+			grid = window
+
+		width = cells - 2 * k
+		running = [ list(map(max, *[ line[ j : j + width ] for j in range(2 * k + 1) ])) for line in grid ]
+		highest = [ list(map(max, *running[ j : j + 2 * k + 1 ])) for j in range(width) ]  # Cell (row, col) at [row - k][col - k]
+
+		rejected = set()  # Cells of rejected plateaus
+
+		for d, dr, dc in search:
+			cell_row = center + dr
+			cell_col = center + dc
+			value = grid[ cell_row ][ cell_col ]
+			if (value == padding or value == nodata or (cell_row, cell_col) in rejected
+					or value != highest[ cell_row - k ][ cell_col - k ]):
+				continue
+
+			# Check plateau of equal neighbouring cells
+
+			plateau = set([ (cell_row, cell_col) ])
+			stack = [ (cell_row, cell_col) ]
+			while stack and len(plateau) <= max_plateau:
+				plateau_row, plateau_col = stack.pop()
+				if (not (k <= plateau_row < cells - k and k <= plateau_col < cells - k)
+						or highest[ plateau_row - k ][ plateau_col - k ] != value):
+					plateau.add(None)  # Reaches window border or something higher
+					break
+				for nr, nc in neighbours:
+					neighbour = (plateau_row + nr, plateau_col + nc)
+					if neighbour in rejected and grid[ neighbour[0] ][ neighbour[1] ] == value:
+						plateau.add(None)  # Part of plateau already rejected
+						stack = []
+						break
+					if neighbour not in plateau and grid[ neighbour[0] ][ neighbour[1] ] == value:
+						plateau.add(neighbour)
+						stack.append(neighbour)
+
+			if None in plateau or len(plateau) > max_plateau:
+				rejected.update(plateau)
+				continue
+
+			# Highest pixel within cell
+
+			best = None
+			for pixel_row in range(cell_row * s, cell_row * s + s):
+				for pixel_col in range(cell_col * s, cell_col * s + s):
+					if best is None or window[ pixel_row ][ pixel_col ] > window[ best[0] ][ best[1] ]:
+						best = (pixel_row, pixel_col)
+
+			if (col0 + best[1], row0 + best[0]) != (col, row):
+				x = dem['x0'] + (col0 + best[1] + 0.5) * dem['dx']
+				y = dem['y0'] - (row0 + best[0] + 0.5) * dem['dy']
+				lat, lon = utm.UtmToLatLon (x, y, dem['zone'], "N")
+				new_points[ i ] = (round(lon, 7), round(lat, 7))
+			break
+
+	end_progress()
+
+	return new_points
+
+
+
 # Match and merge peaks
 
 def match_peaks():
 
-	# Create list of matches within given offset
+	# Create list of matches within given offset.
+	# The grid engine only tests peaks2 with a bbox overlapping the grid cell of peak1. Candidates keep
+	# their original order, so the result is identical to the reference engine, including ties in the sort.
 
 	def create_matches (peaks1, peaks2, offset):
 
+		start_progress("Match within %i m" % offset, len(peaks1))
+
+		if match_engine == "grid":
+			grid = {}
+			for peak2 in peaks2:
+				if "match" not in peak2:
+					for x in range(math.floor(peak2['bbox'][0][0] / grid_size[0]), math.floor(peak2['bbox'][1][0] / grid_size[0]) + 1):
+						for y in range(math.floor(peak2['bbox'][0][1] / grid_size[1]), math.floor(peak2['bbox'][1][1] / grid_size[1]) + 1):
+							if (x, y) not in grid:
+								grid[ (x, y) ] = []
+							grid[ (x, y) ].append(peak2)
+
 		matches = []
 
 		for peak1 in peaks1:
+			update_progress()
 			if "match" not in peak1:
-				for peak2 in peaks2:
+				if match_engine == "grid":
+					cell = (math.floor(peak1['point'][0] / grid_size[0]), math.floor(peak1['point'][1] / grid_size[1]))
+					candidates = grid.get(cell, [])
+				else:
+					candidates = peaks2
+
+				for peak2 in candidates:
 					if ("match" not in peak2
 							and peak2['bbox'][0][0] < peak1['point'][0] < peak2['bbox'][1][0]
 							and peak2['bbox'][0][1] < peak1['point'][1] < peak2['bbox'][1][1]):
@@ -541,6 +1593,8 @@ def match_peaks():
 
 		matches.sort(key=lambda m: m['gap'])  # Sort according to distance
 
+		end_progress()
+
 		return matches
 
 
@@ -740,50 +1794,552 @@ def match_peaks():
 	message ("\tMatched %i SSR peak names with N50\n" % ssr_matched)
 
 
-	# 7. Add remaining peaks from N50 and SSR
+	# 7. Snap remaining SSR peaks to nearest local maximum in DEM
+
+	if dem and snap:
+		snap_peaks = [ peak for peak in ssr_peaks if "match" not in peak ]
+		snap_points = snap_dem(dem, [ peak['point'] for peak in snap_peaks ], snap_radius)
+
+		snapped = 0
+		for peak, point in zip(snap_peaks, snap_points):
+			if point is not None:
+				peak['tags']['SNAP'] = str(int(distance(peak['point'], point)))
+				peak['point'] = point
+				peak['bbox'] = create_bbox(point, max_offset)
+				snapped += 1
+
+		message ("\tSnapped %i SSR peaks to local maximum in DEM\n" % snapped)
+
+
+	# 8. Check elevations against DEM
+
+	if dem:
+		check_peaks = osm_peaks + [ peak for peak in n50_peaks + ssr_peaks if "match" not in peak ]
+		elevations = sample_dem(dem, [ peak['point'] for peak in check_peaks ])
+
+		mismatch = 0
+		suggested = 0
+		for peak, dem_ele in zip(check_peaks, elevations):
+			if dem_ele is None:
+				continue
+			if "ele" in peak['tags']:
+				ele = elevation(peak)
+				if ele is not None and abs(ele - dem_ele) > dem_tolerance:
+					ele_mismatch = str(int(round(ele - dem_ele)))
+					if "xml" in peak:
+						add_tag(peak, "ELE_MISMATCH", ele_mismatch)
+					else:
+						peak['tags']['ELE_MISMATCH'] = ele_mismatch
+					mismatch += 1
+			elif "xml" not in peak:
+				peak['tags']['DEM_ele'] = str(int(round(dem_ele)))  # SSR only peak
+				suggested += 1
+
+		message ("\tFound %i elevation mismatches against DEM\n" % mismatch)
+		message ("\tSuggested DEM elevation for %i SSR peaks\n" % suggested)
+
+
+	# 9. Add remaining peaks from N50 and SSR
+
+	# Each municipality gets its own block of negative ids, to avoid id conflicts when output files are combined.
+	# When streaming, modified OSM elements are written first, and new nodes are written without keeping them.
+	# Modified elements are collected from the OSM tree here, since earlier steps may modify an element several times.
+
+	# Block of municipality n holds ids -1001 - n * id_block down to -1000 - (n + 1) * id_block
+
+	new_peaks = len([ peak for peak in n50_peaks + ssr_peaks if "match" not in peak ])
+	if new_peaks > id_block:
+		sys.exit("\n\n\t*** %i new peaks exceed the block of %i ids for each municipality\n\n" % (new_peaks, id_block))
 
 	added = 0
-	osm_id = -1000
+	osm_id = -1000 - int(municipality_id) * id_block
+	if stream:
+		for element in osm_root:
+			if element.get("action") == "modify":
+				write_element(output, element)
+
+	start_progress("Add peaks", len(n50_peaks) + len(ssr_peaks))
+
 	for peak in n50_peaks + ssr_peaks:
+		update_progress()
 		if "match" not in peak:
 			osm_id -= 1
 			node = ET.Element("node", id=str(osm_id), action="modify", lat=str(peak['point'][1]), lon=str(peak['point'][0]))
 			for key, value in iter(peak['tags'].items()):
 				node.append(ET.Element("tag", k=key, v=value))
-			osm_root.append(node)
+			if stream:
+				write_element(output, node)
+			else:
+				osm_root.append(node)
 			added += 1
 
+	end_progress()
 	message ("\tAdded remaining %i peaks from N50 and SSR\n" % added)
 
 
 
+# Get filename of merged file
+
+def output_filename():
+
+	return "peaks_%s_%s.osm" % (municipality_id, municipality_name.replace(" ", "_"))
+
+
+
+# Open merged file for streaming output of elements, with same header as save_file()
+
+def open_output (filename):
+
+	output = {
+		'file': open(filename, "w", encoding="utf-8"),
+		'buffer': [],
+		'size': 0
+	}
+
+	attributes = dict(osm_root.attrib)
+	attributes['generator'] = "peak2osm"
+	attributes['upload'] = "false"
+
+	output['file'].write("<?xml version='1.0' encoding='utf-8'?>\n")
+	output['file'].write("<osm %s>\n" % " ".join("%s=%s" % (key, quoteattr(value)) for key, value in attributes.items()))
+
+	return output
+
+
+
+# Add element to output buffer, and write buffer to file when full
+
+def write_element (output, element):
+
+	text = ET.tostring(element, encoding="unicode")
+	if not element.tail:
+		text += "\n"
+
+	output['buffer'].append(text)
+	output['size'] += len(text)
+
+	if output['size'] >= output_buffer:
+		output['file'].write("".join(output['buffer']))
+		output['buffer'] = []
+		output['size'] = 0
+
+	metrics['output_buffer'] = output['size']
+
+
+
+# Write remaining buffer and close output file
+
+def close_output (output):
+
+	output['buffer'].append("</osm>\n")
+	output['file'].write("".join(output['buffer']))
+	output['file'].close()
+
+
+
 # Save merged file
 
 def save_file():
 
-	filename = "peaks_%s_%s.osm" % (municipality_id, municipality_name.replace(" ", "_"))
+	filename = output_filename()
 
-	osm_root.set("generator", "peak2osm")
-	osm_root.set("upload", "false")
-	osm_tree.write(filename, encoding='utf-8', method='xml', xml_declaration=True)
+	if stream:
+		close_output(output)
+	else:
+		osm_root.set("generator", "peak2osm")
+		osm_root.set("upload", "false")
+		osm_tree.write(filename, encoding='utf-8', method='xml', xml_declaration=True)
 
 	message ("Saved to file '%s'\n" % filename)
 
 
 
+# Create random synthetic peaks around clusters for verification of matcher engines.
+# Peaks are close enough for all match steps, and some peaks share coordinates to produce ties in distances.
+
+def create_synthetic_peaks (seed, count):
+
+	global ssr_peaks, n50_peaks, osm_peaks, osm_root, osm_tree
+
+	rnd = random.Random(seed)
+
+	names = ["Storhaugen", "Storhaug", "Lillehaugen", "Nuten", "Nutane", "Kollen", "Kolla", "Heia", "Heii",
+				"Toppen", "Åsen", "Ås", "Fjellet", "Fjellnuten", "Varden", "Vardåsen"]
+
+	ssr_peaks = []
+	n50_peaks = []
+	osm_peaks = []
+	osm_root = ET.Element("osm", version="0.6", generator="peak2osm")
+	osm_tree = ET.ElementTree(osm_root)
+
+	def offset_point(point, meters):
+		lon, lat = coordinate_offset(point, rnd.uniform(- meters, meters))
+		return (round(lon if rnd.random() < 0.5 else point[0], 5), round(lat if rnd.random() < 0.5 else point[1], 5))
+
+	side = 0.01 * math.sqrt(count)  # Degrees, about 1 cluster per square kilometer
+	for i in range(count):
+		center = (round(rnd.uniform(10, 10 + 2 * side), 5), round(rnd.uniform(60, 60 + side), 5))
+		name = rnd.choice(names)
+		ele = rnd.randint(100, 1500)
+
+		if rnd.random() < 0.7:
+			point = offset_point(center, 100)
+			node = ET.SubElement(osm_root, "node", id=str(i + 1), version="1", lat=str(point[1]), lon=str(point[0]))
+			tags = {'natural': rnd.choice(["peak", "hill", "hill", "ridge"])}
+			if rnd.random() < 0.8:
+				tags['name'] = rnd.choice([ name, rnd.choice(names) ])
+			if rnd.random() < 0.6:
+				tags['ele'] = str(ele + rnd.choice([-3, 0, 0, 1, 2]))
+			if rnd.random() < 0.1:
+				tags['place'] = "locality"
+			for key, value in tags.items():
+				ET.SubElement(node, "tag", k=key, v=value)
+			osm_peaks.append({ 'point': point, 'tags': get_tags(node), 'bbox': create_bbox(point, max_offset), 'xml': node })
+
+		for j in range(rnd.choice([0, 1, 1, 1, 2])):
+			point = offset_point(center, 400)
+			tags = {'name': rnd.choice([ name, name, rnd.choice(names) ]), 'natural': "hill", 'SSR_TYPE': rnd.choice(["haug", "hei", "ås"])}
+			ssr_peaks.append({ 'point': point, 'tags': tags, 'bbox': create_bbox(point, max_offset) })
+
+		if rnd.random() < 0.8:
+			point = offset_point(center, 60)
+			tags = {'natural': "hill", 'ele': str(ele)}
+			if rnd.random() < 0.2:
+				tags['man_made'] = "survey_point"
+			n50_peaks.append({ 'point': point, 'tags': tags, 'bbox': create_bbox(point, max_offset) })
+
+	# Exact duplicates give equal gaps
+
+	for peaks in [ssr_peaks, n50_peaks]:
+		for peak in rnd.sample(peaks, len(peaks) // 10):
+			peaks.append({ 'point': peak['point'], 'tags': dict(peak['tags']), 'bbox': peak['bbox'] })
+
+
+
+# Run reference and optimized matcher engines side by side on synthetic peaks.
+# Output tags and coordinates must be identical, and for the default number of clusters also identical to the golden
+# output of the original matcher, since changes to code shared by both engines would give identical but wrong results.
+# Exits with error if not.
+
+def verify_matcher (count):
+
+	global match_engine, dem, stream, municipality_id, municipality_name
+
+	message ("Verify matcher engines with %i synthetic peak clusters ...\n" % count)
+
+	municipality_id, municipality_name = "0000", "Verify"
+	dem = None
+	stream = False
+	engines = ["reference", "grid"]
+	failed = 0
+
+	# SHA-256 of output for seeds 1-5, produced by the original matcher before optimisation
+
+	golden_output = {
+		1000: ["15a5133e4d2fae025f0f5b8e3c47e89750a04da77a64acce57bd2f92a0cf846f",
+				"e384a6157ad53be586726ec31e2476471562a9918299566a83a71e06d99cb9b3",
+				"d5edd9c3b2693459fa7c8c7832db0e02d11ff53a2870b9a7fcd8b88cec6018d9",
+				"2f961f54e43c1752d86bff402e2cf29b5c8297aec8a4797767d8ad5c9eaeb678",
+				"9dc27ebd0c09ae7d0b48c99e2dad6dd212a2a01f557abc2d9c4f6ab38be91e6f"]
+	}
+
+	if count not in golden_output:
+		message ("\tNo golden output for %i clusters, only comparing engines\n" % count)
+
+	for seed in range(1, 6):
+		result = {}
+		duration = {}
+
+		for engine in engines:
+			create_synthetic_peaks(seed, count)
+			match_engine = engine
+
+			start_time = time.time()
+			with redirect_stdout(StringIO()):
+				match_peaks()
+			duration[ engine ] = time.time() - start_time
+
+			result[ engine ] = (ET.tostring(osm_root, encoding="unicode"),
+								[ (peak['point'], peak['tags'], peak.get("match", ""), peak.get("match_name", ""))
+									for peak in ssr_peaks + n50_peaks ])
+
+		message ("\tSeed %i: %i OSM, %i SSR, %i N50 peaks, " % (seed, len(osm_peaks), len(ssr_peaks), len(n50_peaks)))
+		message (", ".join("%s %.2f s" % (engine, duration[ engine ]) for engine in engines))
+
+		for engine in engines[1:]:
+			if result[ engine ] == result[ engines[0] ]:
+				message (", %s %.1fx faster, identical" % (engine, duration[ engines[0] ] / max(duration[ engine ], 0.001)))
+			else:
+				message (", *** %s differs from %s" % (engine, engines[0]))
+				failed += 1
+
+		if count in golden_output:
+			if hashlib.sha256(repr(result[ engines[0] ]).encode("utf-8")).hexdigest() == golden_output[ count ][ seed - 1 ]:
+				message (", same as original")
+			else:
+				message (", *** %s differs from original matcher" % engines[0])
+				failed += 1
+
+		message ("\n")
+
+	if failed:
+		sys.exit("\n\t*** %i differences found\n\n" % failed)
+
+	message ("Done\n\n")
+
+
+
+# Run incremental update of OSM snapshot against simulated Overpass responses.
+# Covers elements which are changed, deleted, new, and unchanged but pulled in by a changed way, and a snapshot left
+# incomplete by an interrupted run. Exits with error if the updated snapshot or the loaded peaks differ from the expected result.
+
+def verify_update():
+
+	global municipality_id, municipality_name, cache, update, osm_peaks
+
+	message ("Verify incremental update of OSM snapshot ...\n")
+
+	def node(node_id, version, tags):
+		return ('<node id="%i" version="%i" timestamp="2024-01-01T00:00:00Z" changeset="%i" uid="1" user="test" lat="60.%i" lon="10.0">%s</node>'
+					% (node_id, version, version, node_id, "".join('<tag k="%s" v="%s"/>' % tag for tag in tags.items())))
+
+	def way(way_id, version, nodes, tags):
+		return ('<way id="%i" version="%i" timestamp="2024-01-01T00:00:00Z" changeset="%i" uid="1" user="test">%s%s</way>'
+					% (way_id, version, version, "".join('<nd ref="%i"/>' % ref for ref in nodes),
+						"".join('<tag k="%s" v="%s"/>' % tag for tag in tags.items())))
+
+	def osm(osm_base, elements):
+		return ('<?xml version="1.0" encoding="UTF-8"?><osm version="0.6" generator="Overpass API">'
+					'<note>Test</note><meta osm_base="%s"/>%s</osm>' % (osm_base, "".join(elements))).encode("utf-8")
+
+	# Node 1 changed, node 2 unchanged, node 5 deleted, node 6 new, node 7 pulled in by changed way 3
+
+	responses = {
+		'full': osm("2024-01-01T00:00:00Z", [
+					node(1, 1, {'natural': "peak", 'name': "Toppen"}),
+					node(2, 1, {}),
+					node(5, 1, {'natural': "hill", 'name': "Haugen"}),
+					way(3, 1, [1, 2], {'natural': "ridge"}) ]),
+		'newer': osm("2024-02-01T00:00:00Z", [
+					'<node id="1"/><node id="2"/><node id="6"/><node id="7"/><way id="3"/>',
+					node(1, 2, {'natural': "peak", 'name': "Storetoppen"}),
+					node(6, 1, {'natural': "hill", 'name': "Nyhaugen"}),
+					way(3, 2, [1, 2, 7], {'natural': "ridge"}) ]),
+		'(id:': osm("2024-02-01T00:00:00Z", [
+					node(7, 4, {}) ])
+	}
+
+	expected = {
+		('node', "1"): ("2", {'natural': "peak", 'name': "Storetoppen"}, []),
+		('node', "2"): ("1", {}, []),
+		('node', "6"): ("1", {'natural': "hill", 'name': "Nyhaugen"}, []),
+		('node', "7"): ("4", {}, []),
+		('way', "3"): ("2", {'natural': "ridge"}, ["1", "2", "7"])
+	}
+
+	queries = []
+
+	def simulated_urlopen(request):
+		query = urllib.parse.unquote(request.full_url.split("?data=", 1)[1])
+		queries.append(query)
+		for key in ["newer", "(id:"]:
+			if key in query:
+				return BytesIO(responses[ key ])
+		return BytesIO(responses['full'])
+
+	def snapshot(root):
+		return dict(((element.tag, element.get("id")), (element.get("version"), get_tags(element),
+						[ nd.get("ref") for nd in element.findall("nd") ]))
+						for element in root if element.tag in ["node", "way", "relation"])
+
+	failed = []
+	urlopen = urllib.request.urlopen
+	current_folder = os.getcwd()
+	temp_folder = tempfile.TemporaryDirectory()
+
+	try:
+		os.chdir(temp_folder.name)
+		urllib.request.urlopen = simulated_urlopen
+		municipality_id, municipality_name = "0000", "Verify"
+		cache = False
+		update = True
+
+		result = {}
+		for run in ["Initial snapshot", "Update"]:
+			osm_peaks = []
+			with redirect_stdout(StringIO()):
+				load_osm_peaks()
+			result[ run ] = snapshot(osm_root)
+			message ("\t%s: %i elements, %i peaks\n" % (run, len(result[ run ]), len(osm_peaks)))
+
+		if snapshot(osm_root) != expected:
+			failed.append("updated elements differ")
+		if snapshot(osm_xml(load_peak_file(cache_filename("osm")))) != expected:
+			failed.append("saved snapshot differs")
+		if osm_root.find("meta").get("osm_base") != "2024-02-01T00:00:00Z":
+			failed.append("timestamp of snapshot not updated")
+		if sorted(peak['tags']['name'] for peak in osm_peaks) != ["Nyhaugen", "Storetoppen"]:
+			failed.append("loaded peaks differ")
+		if len(queries) != 3 or "newer" not in queries[1] or "node(id:7);" not in queries[2]:
+			failed.append("unexpected queries")
+
+		# Snapshot left incomplete by an interrupted run must be replaced by a full load
+
+		file = open(cache_filename("osm"), "r+b")
+		file.truncate(os.path.getsize(cache_filename("osm")) // 2)
+		file.close()
+
+		with redirect_stdout(StringIO()):
+			load_osm_peaks()
+		message ("\tIncomplete snapshot: %i elements\n" % len(snapshot(osm_root)))
+
+		if len(queries) != 4 or "newer" in queries[3] or snapshot(osm_root) != result["Initial snapshot"]:
+			failed.append("incomplete snapshot not reloaded")
+		if not valid_peak_file(cache_filename("osm")):
+			failed.append("incomplete snapshot not replaced")
+
+	finally:
+		urllib.request.urlopen = urlopen
+		os.chdir(current_folder)
+		temp_folder.cleanup()
+
+	if failed:
+		sys.exit("\n\t*** Update failed: %s\n\n" % ", ".join(failed))
+
+	message ("\tChanged, deleted, new and pulled in elements are identical to expected result, incomplete snapshot reloaded\n")
+	message ("Done\n\n")
+
+
+
+# Merge synthetic new peaks and save the merged file in one output mode, for benchmark_output().
+# Runs in a fresh process, since peak RSS can only grow within a process. Puts RSS increase and file size into queue.
+
+def benchmark_output_run (mode, count, folder, results):
+
+	global municipality_id, municipality_name, ssr_peaks, n50_peaks, osm_peaks, osm_root, osm_tree, dem, stream, output
+
+	import resource  # Not available on Windows
+
+	os.chdir(folder)
+	rnd = random.Random(1)
+
+	municipality_id, municipality_name = "0000", "Benchmark"
+	dem = None
+	stream = (mode == "stream")
+	ssr_peaks = []
+	osm_peaks = []
+	osm_root = ET.Element("osm", version="0.6", generator="peak2osm")
+	osm_tree = ET.ElementTree(osm_root)
+	n50_peaks = []
+	for i in range(count):
+		point = (round(rnd.uniform(5, 30), 7), round(rnd.uniform(58, 71), 7))
+		tags = {'natural': "hill", 'ele': str(rnd.randint(0, 2400)), 'name': "Topp %i" % i}
+		n50_peaks.append({ 'point': point, 'tags': tags, 'bbox': create_bbox(point, max_offset) })
+
+	before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	with redirect_stdout(StringIO()):
+		if stream:
+			output = open_output(output_filename())
+		match_peaks()
+		save_file()
+	after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+	unit = 1024 * 1024 if sys.platform == "darwin" else 1024  # ru_maxrss is bytes on macOS, else kB
+	results.put(((after - before) / unit, os.path.getsize(output_filename()) / 1000000))
+
+
+
+# Measure peak RSS of the merge and output steps for tree output versus -stream, for increasing number of new peaks
+
+def benchmark_output (count):
+
+	message ("Benchmark peak memory of merged file output with up to %i new peaks ...\n" % count)
+
+	context = multiprocessing.get_context("spawn")
+	temp_folder = tempfile.TemporaryDirectory()
+
+	try:
+		for peaks in [ count // 10, count // 2, count ]:
+			result = {}
+			for mode in ["tree", "stream"]:
+				results = context.Queue()
+				process = context.Process(target=benchmark_output_run, args=(mode, peaks, temp_folder.name, results))
+				process.start()
+				process.join()
+				if process.exitcode != 0:
+					sys.exit("\n\t*** Benchmark of %s output failed\n\n" % mode)
+				result[ mode ] = results.get()
+
+			message ("\t%7i peaks: tree %6.1f MB, stream %6.1f MB peak RSS increase, file %.1f MB\n"
+						% (peaks, result['tree'][0], result['stream'][0], result['tree'][1]))
+
+	finally:
+		temp_folder.cleanup()
+
+	message ("Done\n\n")
+
+
+
 # Main program
 
 if __name__ == '__main__':
 
 	message ("\n")
 
-	# Get municipality
+	# Benchmark or verify instead of merging
 
-	if len(sys.argv) > 1:
-		municipality_id, municipality_name = get_municipality(sys.argv[1])
-	else:
+	if len(sys.argv) > 1 and sys.argv[1].startswith("-benchmark-output"):
+		benchmark_output(int(sys.argv[1][18:]) if sys.argv[1].startswith("-benchmark-output=") else 100000)
+		sys.exit()
+
+	if len(sys.argv) > 1 and sys.argv[1] == "-verify-update":
+		verify_update()
+		sys.exit()
+
+	if len(sys.argv) > 1 and sys.argv[1].startswith("-verify"):
+		verify_matcher(int(sys.argv[1][8:]) if sys.argv[1].startswith("-verify=") else 1000)
+		sys.exit()
+
+	if len(sys.argv) < 2:
 		sys.exit("Please enter municipality name or number\n")
 
+	# Get options
+
+	for arg in sys.argv[2:]:
+		if arg.startswith("-dem="):
+			dem_filename = arg[5:]
+		elif arg == "-cache":
+			cache = True
+		elif arg == "-update":
+			update = True
+		elif arg.startswith("-metrics="):
+			metrics_port = int(arg[9:])
+		elif arg.startswith("-heartbeat="):
+			heartbeat_filename = arg[11:]
+		elif arg.startswith("-engine=") and arg[8:] in ["grid", "reference"]:
+			match_engine = arg[8:]
+		elif arg == "-stream":
+			stream = True
+		elif arg.startswith("-stream="):
+			stream = True
+			output_buffer = int(arg[8:])
+		elif arg == "-snap":
+			snap = True
+		elif arg.startswith("-snap="):
+			snap = True
+			snap_radius = float(arg[6:])
+		else:
+			sys.exit("Unknown option '%s'\n" % arg)
+
+	if snap and not dem_filename:
+		sys.exit("Option -snap requires -dem\n")
+
+	# Get municipality, after options since -cache may avoid the lookup
+
+	municipality_id, municipality_name = get_municipality(sys.argv[1])
+
+	start_metrics()
+
 	# Load data
 
 	ssr_peaks = []
@@ -799,6 +2355,14 @@ if __name__ == '__main__':
 	load_n50_peaks()
 	load_osm_peaks()
 
+	if dem_filename:
+		dem = load_dem(dem_filename)
+	else:
+		dem = None
+
+	if stream:
+		output = open_output(output_filename())
+
 	match_peaks()
 
 	save_file()
@@ -806,5 +2370,9 @@ if __name__ == '__main__':
 	if debug:
 		logfile.close()
 
+	metrics['stage'] = "Done"
+	if heartbeat_filename:
+		save_heartbeat()
+
 	message ("\n")
 